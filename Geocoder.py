@@ -4,10 +4,16 @@ from shapely.geometry import Point
 import pandas as pd
 from geopy.geocoders import Nominatim
 from geopy.exc import GeocoderTimedOut
-from opencage.geocoder import OpenCageGeocode
+from opencage.geocoder import OpenCageGeocode, RateLimitExceededError
 from googlemaps import Client as GoogleMaps
 import os
+import json
+import math
 import time
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from dotenv import load_dotenv
 from censusgeocode import CensusGeocode
 
@@ -30,9 +36,168 @@ census = CensusGeocode()
 geocoding_successes = {'census': 0, 'opencage': 0, 'nominatim': 0}
 geocoding_failures = {'census': 0, 'opencage': 0, 'nominatim': 0}
 
+# Hedged lookup bookkeeping
+# provider_latencies holds the latest network call latencies (seconds) for each provider, used to pick the hedge delay
+# hedged_calls counts the extra calls fired while a higher priority provider was still running (extra quota spent)
+# hedged_discarded counts losing calls still in flight when the lookup returned, those can't be interrupted
+# so they still spend quota, but their result isn't used or counted in geocoding_successes/failures
+LATENCY_SAMPLES = 200
+provider_latencies = {service: deque(maxlen=LATENCY_SAMPLES) for service in ['census', 'opencage', 'nominatim']}
+hedged_calls = {'census': 0, 'opencage': 0, 'nominatim': 0}
+hedged_discarded = {'census': 0, 'opencage': 0, 'nominatim': 0}
+hedged_lookup_latencies = []
+
+# Hedged provider calls run in worker threads and collect their success/failure counts here instead of
+# the globals, the lookup only adds them in once it knows the call wasn't discarded
+provider_call_counts = threading.local()
+
+# Provider quota ledger, persisted between runs so daily caps carry over
+# limit is requests per window (None for no cap), window is in seconds and aligned to UTC,
+# so a 86400 window resets at midnight UTC like the OpenCage free tier
+# Adjust the limits to your own plans
+QUOTA_LEDGER_FILE = 'provider_quota_ledger.json'
+provider_quotas = {
+    'census': {'limit': None, 'window': 86400},
+    'opencage': {'limit': 2500, 'window': 86400},
+    'nominatim': {'limit': None, 'window': 86400}
+}
+quota_ledger = {}  # service -> {'used': requests this window, 'window_start': epoch seconds}
+quota_lock = threading.Lock()  # hedged lookups call providers from several threads
+
+
+def load_quota_ledger(ledger_file=QUOTA_LEDGER_FILE):
+    """
+    Load the persisted provider usage, missing file means nothing has been used yet
+    An unreadable ledger is treated as unknown usage (starting from zero) rather than stopping the run
+    """
+    if not os.path.exists(ledger_file):
+        return
+    try:
+        with open(ledger_file, 'r') as f:
+            quota_ledger.update(json.load(f))
+    except (OSError, ValueError) as e:
+        print(f"Warning: could not read quota ledger {ledger_file}, usage this window is unknown. Error: {str(e)}")
+
+
+def save_quota_ledger(ledger_file=QUOTA_LEDGER_FILE):
+    # Write to a temp file and swap it in, so an interrupted write never leaves a truncated ledger
+    temp_file = f'{ledger_file}.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump(quota_ledger, f, indent=2)
+    os.replace(temp_file, ledger_file)
+
+
+def current_quota_window(service):
+    """
+    Ledger entry for the current window, resetting usage if the last window has passed
+    Call with quota_lock held
+    """
+    window = provider_quotas[service]['window']
+    window_start = time.time() // window * window
+    entry = quota_ledger.setdefault(service, {'used': 0, 'window_start': window_start})
+    if entry['window_start'] < window_start:
+        entry['used'] = 0
+        entry['window_start'] = window_start
+        entry['refused'] = False
+    return entry
+
+
+def has_quota(service):
+    limit = provider_quotas[service]['limit']
+    if limit is None:
+        return True
+    with quota_lock:
+        return current_quota_window(service)['used'] < limit
+
+
+def try_reserve_quota(service):
+    """
+    Check for budget and count the request in one go, so parallel calls (i.e. hedged lookups) can't all pass
+    the check at limit - 1 and overspend. Returns False if there's nothing left this window.
+    """
+    limit = provider_quotas[service]['limit']
+    # Nothing to track for providers without a cap
+    if limit is None:
+        return True
+    with quota_lock:
+        entry = current_quota_window(service)
+        if entry['used'] >= limit:
+            return False
+        entry['used'] += 1
+        save_quota_ledger()
+        return True
+
+
+def mark_quota_exhausted(service, refused=True):
+    """
+    The provider told us the quota for this window is used up (i.e. OpenCage 402), treat the rest of the window
+    as used up. Not for per second throttling (429), that clears by itself.
+    refused: the request itself was turned down, False when it was answered but reported no quota left after it
+    """
+    with quota_lock:
+        entry = current_quota_window(service)
+        entry['used'] = max(entry['used'], provider_quotas[service]['limit'] or 0)
+        entry['refused'] = entry.get('refused', False) or refused
+        save_quota_ledger()
+
+
+def quota_refused(service):
+    """
+    Whether the provider has turned a request down for quota this window
+    """
+    if provider_quotas[service]['limit'] is None:
+        return False
+    with quota_lock:
+        return current_quota_window(service).get('refused', False)
+
+
+def opencage_geocode_with_backoff(address, retries=2, backoff=1.0):
+    """
+    OpenCage lookup returning the raw response (results plus the 'rate' quota block).
+    The client raises the same RateLimitExceededError for 402 (daily quota used up) and 429 (too many requests
+    per second) without the status, so back off and retry. A 429 clears within the backoff, if it's still
+    raised after the retries the quota is gone and the error is passed on.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return opencage.geocode(address, raw_response=True)
+        except RateLimitExceededError:
+            if attempt == retries:
+                raise
+            print(f"OpenCage rate limited, retrying in {backoff * 2 ** attempt} seconds")
+            time.sleep(backoff * 2 ** attempt)
+
+
+def quota_reset_time(service):
+    with quota_lock:
+        entry = current_quota_window(service)
+    reset = entry['window_start'] + provider_quotas[service]['window']
+    return datetime.fromtimestamp(reset, tz=timezone.utc).strftime('%Y-%m-%d %H:%M UTC')
+
+
+load_quota_ledger()
+
+
+def count_geocoding(service, success):
+    """
+    Count a provider success/failure, held back for the lookup to decide on inside a hedged call
+    """
+    held_counts = getattr(provider_call_counts, 'held', None)
+    if held_counts is not None:
+        held_counts.append((service, success))
+    elif success:
+        geocoding_successes[service] += 1
+    else:
+        geocoding_failures[service] += 1
+
 
 def geocode_address_census(address):
     threshold = 85
+    if not try_reserve_quota('census'):
+        print(f"Census quota used up until {quota_reset_time('census')}, skipping address: {address}")
+        count_geocoding('census', False)
+        return None, None, None
+
     try:
         result = census.onelineaddress(address)
 
@@ -41,59 +206,90 @@ def geocode_address_census(address):
             matchedAddress = result[0]['matchedAddress']
 
             print(f"Census geocoding successful for address: {address}")
-            geocoding_successes['census'] += 1
+            count_geocoding('census', True)
             return Point(coords['x'], coords['y']), 'census', matchedAddress
         else:
             print(f"Census geocoding failed for address: {address}")
-            geocoding_failures['census'] += 1
+            count_geocoding('census', False)
     except Exception as e:
         print(f"Census geocoding error for address: {address}. Error: {str(e)}")
-        geocoding_failures['census'] += 1
+        count_geocoding('census', False)
     return None, None, None
 
 
 def geocode_address_opencage(address):
     threshold = 7
+    # Fail fast instead of a network round trip once the daily cap is used up
+    if not try_reserve_quota('opencage'):
+        print(f"OpenCage quota used up until {quota_reset_time('opencage')}, skipping address: {address}")
+        count_geocoding('opencage', False)
+        return None, None, None
+
     try:
-        result = opencage.geocode(address)
+        response = opencage_geocode_with_backoff(address)
+        result = response.get('results') if response else None
+
+        # Catches this run using up the last of the quota on the provider's count (i.e. the ledger under-counts),
+        # the next call is skipped instead of being turned down
+        rate = response.get('rate') if response else None
+        if rate and rate.get('remaining', 1) <= 0:
+            print(f"OpenCage reports no quota remaining until {quota_reset_time('opencage')}")
+            mark_quota_exhausted('opencage', refused=False)
+
         if result and len(result):
             location = result[0]['geometry']
             confidence = result[0]['confidence']
             if confidence >= threshold:
                 print(f"OpenCage geocoding successful for address: {address}")
-                geocoding_successes['opencage'] += 1
+                count_geocoding('opencage', True)
                 return Point(location['lng'], location['lat']), 'opencage', confidence
             else:
                 print(f"OpenCage geocoding confidence is too low, below threshold. Confidence: {confidence}")
-                geocoding_failures['opencage'] += 1
+                count_geocoding('opencage', False)
         else:
             print(f"OpenCage geocoding failed for address: {address}")
-            geocoding_failures['opencage'] += 1
+            count_geocoding('opencage', False)
+    except RateLimitExceededError as e:
+        # Still limited after backing off, so it's the quota (402) not a per second throttle (429)
+        # Happens when the ledger under-counts, i.e. a shared key, a reset ledger or a first run mid-day
+        print(f"OpenCage quota used up for address: {address}. Error: {str(e)}")
+        mark_quota_exhausted('opencage')
+        count_geocoding('opencage', False)
     except Exception as e:
         print(f"OpenCage geocoding error for address: {address}. Error: {str(e)}")
-        geocoding_failures['opencage'] += 1
+        count_geocoding('opencage', False)
     return None, None, None
 
 
 def geocode_address_nominatim(address):
     # Replace with your own description and email in this format (please don't use my email)
     geolocator = Nominatim(user_agent="your-app-name <your-email@example.com>")
+    if not try_reserve_quota('nominatim'):
+        print(f"Nominatim quota used up until {quota_reset_time('nominatim')}, skipping address: {address}")
+        count_geocoding('nominatim', False)
+        return None, None, None
+
     try:
         location = geolocator.geocode(address)
         if location:
             print(f"Nominatim geocoding successful for address: {address}")
-            geocoding_successes['nominatim'] += 1
+            count_geocoding('nominatim', True)
             return Point(location.longitude, location.latitude), 'nominatim', 'N/A'
         else:
             print(f"Nominatim geocoding failed for address: {address}")
-            geocoding_failures['nominatim'] += 1
+            count_geocoding('nominatim', False)
     except (GeocoderTimedOut, geopy.exc.GeocoderUnavailable):
         print(f"Nominatim geocoding request failed for address: {address}")
-        geocoding_failures['nominatim'] += 1
+        count_geocoding('nominatim', False)
     return None, None, None
 
 
-def geocode_address(address):
+def geocode_address(address, hedged=False, **hedge_options):
+    # Hedged mode races the providers instead, for interactive single address lookups
+    # hedge_options are passed through to geocode_address_hedged, i.e. hedge_percentile=95
+    if hedged:
+        return geocode_address_hedged(address, **hedge_options)
+
     # Try the US Census Geocoder first
     # Highest limits, allows multibatching and multiple calls for future use, doesn't need an API key
     result, service, match = geocode_address_census(address)
@@ -115,6 +311,148 @@ def geocode_address(address):
     return None, None, None
 
 
+def latency_percentile(samples, percentile):
+    """
+    Nearest rank percentile of a list of latencies, None if there are no samples
+    """
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = max(1, math.ceil(len(ordered) * percentile / 100))
+    return ordered[rank - 1]
+
+
+def timed_provider_call(service, geocode_function, address):
+    """
+    Run a single provider lookup in a hedging worker thread and record how long it took
+    Returns the lookup result and the success/failure counts it held back
+    """
+    # Out of quota calls fail straight away without a network call, don't let them drag the percentile down
+    network_call = has_quota(service)
+    provider_call_counts.held = []
+    start_time = time.time()
+    try:
+        result = geocode_function(address)
+        return result, provider_call_counts.held
+    finally:
+        provider_call_counts.held = None
+        if network_call:
+            provider_latencies[service].append(time.time() - start_time)
+
+
+def geocode_address_hedged(address, hedge_percentile=90, default_hedge_delay=2.0, min_samples=10,
+                           priority_grace=0.5):
+    """
+    Hedged version of geocode_address for latency sensitive single address lookups.
+
+    Providers are tried in the same priority order (Census, OpenCage, Nominatim), but if a provider
+    hasn't answered within its hedge_percentile latency the next provider is fired in parallel instead
+    of waiting for the full timeout. Once an acceptable result comes back, higher priority providers still
+    running get up to priority_grace seconds more, then the best result by provider priority is returned
+    and the rest are discarded. Confidence thresholds are still enforced inside each provider function.
+
+    Parameters:
+    address: Single line address
+    hedge_percentile: Latency percentile of a provider's past calls to wait before hedging (default 90)
+    default_hedge_delay: Seconds to wait before hedging while a provider has too few samples (default 2.0)
+    min_samples: Number of recorded calls needed before the percentile is trusted (default 10)
+    priority_grace: Seconds to wait on higher priority providers after a lower priority one answers (default 0.5)
+    """
+    providers = [
+        ('census', geocode_address_census),
+        ('opencage', geocode_address_opencage),
+        ('nominatim', geocode_address_nominatim)
+    ]
+
+    start_time = time.time()
+    executor = ThreadPoolExecutor(max_workers=len(providers))
+    pending = {}  # future -> provider priority
+    results = {}  # provider priority -> (result, service, match)
+    next_provider = 0
+    grace_deadline = None
+
+    def hedge_delay(service):
+        samples = provider_latencies[service]
+        if len(samples) < min_samples:
+            return default_hedge_delay
+        return latency_percentile(samples, hedge_percentile)
+
+    try:
+        while True:
+            # Fire the next provider if nothing acceptable has come back yet
+            # Either the last one failed or it's slower than its usual tail latency
+            if not results and next_provider < len(providers):
+                service, geocode_function = providers[next_provider]
+                if pending:
+                    print(f"Hedging {address} with {service}")
+                    hedged_calls[service] += 1
+                future = executor.submit(timed_provider_call, service, geocode_function, address)
+                pending[future] = next_provider
+                next_provider += 1
+
+            if not pending:
+                break
+
+            if results:
+                # Give higher priority providers still running a short grace period to answer
+                higher_priority = [future for future, priority in pending.items() if priority < min(results)]
+                if not higher_priority:
+                    break
+                if grace_deadline is None:
+                    grace_deadline = time.time() + priority_grace
+                remaining = grace_deadline - time.time()
+                if remaining <= 0:
+                    break
+                done, _ = wait(higher_priority, timeout=remaining, return_when=FIRST_COMPLETED)
+            else:
+                # Only wait on a timeout while there's still another provider left to hedge with
+                timeout = hedge_delay(providers[next_provider - 1][0]) if next_provider < len(providers) else None
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                priority = pending.pop(future)
+                (result, service, match), held_counts = future.result()
+
+                # The call finished and was looked at, so it counts towards the totals
+                for counted_service, success in held_counts:
+                    count_geocoding(counted_service, success)
+                if result:
+                    results[priority] = (result, service, match)
+    finally:
+        # Every call gets a worker straight away, so losers are already in flight and can't be cancelled,
+        # their results are discarded (and never added to the success/failure totals)
+        for future, priority in pending.items():
+            hedged_discarded[providers[priority][0]] += 1
+        executor.shutdown(wait=False)
+        hedged_lookup_latencies.append(time.time() - start_time)
+
+    if results:
+        return results[min(results)]
+
+    print(f'All services failed on {address}')
+    return None, None, None
+
+
+def print_hedging_statistics(percentiles=(50, 90, 99)):
+    """
+    Print tail latency of hedged lookups and the extra quota spent on hedged calls
+    """
+    print("\nHedged lookup latency:")
+    print(f"Lookups: {len(hedged_lookup_latencies)}")
+    for percentile in percentiles:
+        latency = latency_percentile(hedged_lookup_latencies, percentile)
+        if latency is not None:
+            print(f"p{percentile}: {round(latency, 3)} seconds")
+
+    for service in ['census', 'opencage', 'nominatim']:
+        print(f"\n{service.capitalize()} hedging:")
+        print(f"Extra hedged calls: {hedged_calls[service]}")
+        print(f"Discarded calls: {hedged_discarded[service]}")
+        latency = latency_percentile(provider_latencies[service], 90)
+        if latency is not None:
+            print(f"p90 latency: {round(latency, 3)} seconds")
+
+
 def prepare_census_batch(df):
     """
     Prepare data for Census batch geocoding.
@@ -185,28 +523,130 @@ def process_census_results(results, original_df):
 def geocode_remaining_addresses(df):
     """
     Geocode addresses that failed with Census using backup services
+    Providers without remaining quota are skipped, rows that failed with a provider skipped for quota
+    are marked 'deferred' (geometry left empty) so they get picked up again in the next window
     """
     mask = df['geometry'].isna()
     if not mask.any():
         return df
 
+    # Fallback providers in priority order
+    providers = [
+        ('opencage', geocode_address_opencage),
+        ('nominatim', geocode_address_nominatim)
+    ]
+    deferred = 0
+
     for idx, row in df[mask].iterrows():
         address = f"{row['StudentAddress']}, {row['StudentCity']}, {row['StudentState']} {row['StudentZip']}"
 
-        # Try OpenCage
-        result, service, match = geocode_address_opencage(address)
-        if result:
-            df.loc[idx, 'geometry'] = result
-            df.loc[idx, 'geocoding_service'] = service
-            df.loc[idx, 'match_score'] = match
-            continue
-
-        # Try Nominatim
-        result, service, match = geocode_address_nominatim(address)
-        if result:
-            df.loc[idx, 'geometry'] = result
-            df.loc[idx, 'geocoding_service'] = service
-            df.loc[idx, 'match_score'] = match
+        # Route to providers with budget left, no network call at all for the ones without
+        # skipped holds the providers this row never really got an answer from because of quota
+        skipped = set()
+
+        for service, geocode_function in providers:
+            if not has_quota(service):
+                skipped.add(service)
+                continue
+
+            refused_before = quota_refused(service)
+            result, result_service, match = geocode_function(address)
+            if result:
+                df.loc[idx, 'geometry'] = result
+                df.loc[idx, 'geocoding_service'] = result_service
+                df.loc[idx, 'match_score'] = match
+                break
+
+            # The provider turned this request down for quota (402), so it wasn't really tried
+            if quota_refused(service) and not refused_before:
+                skipped.add(service)
+        else:
+            if skipped:
+                df.loc[idx, 'geocoding_service'] = 'deferred'
+                deferred += 1
+
+    if deferred:
+        resets = ', '.join(f"{service} at {quota_reset_time(service)}"
+                           for service, _ in providers if not has_quota(service))
+        print(f"Deferred {deferred} addresses to the next quota window ({resets})")
+
+    return df
+
+
+def load_boundary_layers(layer_files):
+    """
+    Load polygon boundary layers once for zone enrichment, i.e. attendance zones, tracts
+
+    Parameters:
+    layer_files: Dict of output column name -> (path to boundary file, zone ID column in that file)
+
+    Returns a dict of output column name -> GeoDataFrame with just the zone ID and geometry,
+    reprojected to EPSG:4326 with its STRtree spatial index already built
+    """
+    boundary_layers = {}
+
+    for layer_name, (layer_path, id_col) in layer_files.items():
+        layer = gpd.read_file(layer_path)
+        if layer.crs is not None and layer.crs != "EPSG:4326":
+            layer = layer.to_crs("EPSG:4326")
+
+        layer = layer[[id_col, 'geometry']].rename(columns={id_col: layer_name})
+
+        # Building the sindex here caches the STRtree on the layer, enrich_with_zones queries it for every chunk
+        layer.sindex
+        boundary_layers[layer_name] = layer
+        print(f"Loaded boundary layer {layer_name}: {len(layer)} polygons from {layer_path}")
+
+    return boundary_layers
+
+
+def enrich_with_zones(df, boundary_layers, chunk_size=100000, predicate='intersects'):
+    """
+    Assign zone IDs to geocoded points with a bulk spatial query against each boundary layer's STRtree.
+    Adds one column per layer, rows without geometry or outside every polygon are left empty.
+    A point matching more than one polygon (overlaps, or on a shared edge with 'intersects') gets the zone
+    that comes first in the boundary file.
+    Runs chunk-wise so memory stays bounded for large files.
+
+    Parameters:
+    df: DataFrame with a geometry column, either shapely Points or WKT strings (read back from csv)
+    boundary_layers: Output of load_boundary_layers
+    chunk_size: Number of points joined at a time (default 100000)
+    predicate: 'intersects' (default) also matches points exactly on a zone edge, geocoded points often land
+               on the street centrelines zones and tracts are drawn along. 'within' leaves those empty
+    """
+    for layer_name in boundary_layers:
+        df[layer_name] = None
+
+    mask = df['geometry'].notna()
+    if not mask.any():
+        return df
+
+    geocoded = df.loc[mask, 'geometry']
+
+    for start_idx in range(0, len(geocoded), chunk_size):
+        chunk = geocoded.iloc[start_idx:start_idx + chunk_size]
+
+        if isinstance(chunk.iloc[0], str):
+            points = gpd.GeoSeries.from_wkt(chunk, crs="EPSG:4326")
+        else:
+            points = gpd.GeoSeries(chunk, crs="EPSG:4326")
+
+        for layer_name, layer in boundary_layers.items():
+            # Bulk query against the layer's own STRtree
+            # (gpd.sjoin would build a fresh tree on every points chunk instead)
+            point_idx, zone_idx = layer.sindex.query(points, predicate=predicate)
+
+            # STRtree hands matches back in traversal order, sort so a point matching several polygons
+            # always keeps the one first in the boundary file
+            matches = pd.DataFrame({'point': point_idx, 'zone': zone_idx}).sort_values(['point', 'zone'])
+            matches = matches.drop_duplicates(subset='point', keep='first')
+
+            zones = pd.Series(layer[layer_name].to_numpy()[matches['zone'].to_numpy()],
+                              index=points.index[matches['point'].to_numpy()])
+            df.loc[zones.index, layer_name] = zones
+
+        print(f"Zone enrichment: {min(start_idx + chunk_size, len(geocoded))}/{len(geocoded)} points joined")
 
     return df
 
@@ -8,6 +8,8 @@ from opencage.geocoder import OpenCageGeocode
 from googlemaps import Client as GoogleMaps
 import os
 import time
+import hashlib
+from shapely import wkt
 from dotenv import load_dotenv
 from censusgeocode import CensusGeocode
 from Geocoder import *
@@ -40,6 +42,9 @@ census = CensusGeocode()
 geocoding_successes = {'census': 0, 'opencage': 0, 'nominatim': 0}
 geocoding_failures = {'census': 0, 'opencage': 0, 'nominatim': 0}
 
+# Result columns carried forward for unchanged rows in delta mode
+DELTA_RESULT_COLUMNS = ['geometry', 'geocoding_service', 'match_score', 'latitude', 'longitude']
+
 
 def prepare_census_batch(df, address_col, city_col, state_col, zip_col):
     """
@@ -166,12 +171,141 @@ def process_census_results(results, original_df, id_column='ID'):
     return original_df
 
 
+def address_fingerprint(df, address_cols):
+    """
+    Hash each row's address columns so new/changed addresses can be spotted between runs
+    Values are stripped and upper cased, and a trailing .0 is dropped so a zip read as float still matches
+    """
+    normalized = df[address_cols].astype(str).apply(
+        lambda col: col.str.strip().str.upper().str.replace(r'\.0$', '', regex=True))
+
+    # Built as an explicit Series, agg over axis=1 hands back a DataFrame when there are no rows
+    joined = pd.Series(['|'.join(values) for values in normalized.itertuples(index=False)],
+                       index=df.index, dtype=object)
+    return joined.map(lambda value: hashlib.sha1(value.encode('utf-8')).hexdigest())
+
+
+def batch_file_year(file_name):
+    """
+    Year from a batch file name made by prepare_census_batch_limit, i.e. census_batch_2020_1_5000.csv
+    """
+    parts = os.path.splitext(file_name)[0].split('_')
+    return parts[2] if len(parts) == 5 else None
+
+
+def load_previous_geocodes(geocode_folder, address_cols, key_column=None):
+    """
+    Load the previous run's outputs from geocode_folder for delta geocoding
+
+    Returns:
+    previous_results: fingerprint -> previous result columns, only for rows that were geocoded
+    previous_fingerprints: every fingerprint seen last run, geocoded or not
+    previous_keys: (year, stable row ID) seen last run, to tell changed rows apart from new ones,
+                   empty without a key_column
+    """
+    previous_results = {}
+    previous_fingerprints = set()
+    previous_keys = set()
+
+    if not geocode_folder or not os.path.isdir(geocode_folder):
+        return previous_results, previous_fingerprints, previous_keys
+
+    for file_name in os.listdir(geocode_folder):
+        if not file_name.endswith('.csv'):
+            continue
+
+        previous_df = pd.read_csv(rf'{geocode_folder}\{file_name}', low_memory=False)
+        if previous_df.empty:
+            continue
+
+        previous_df['fingerprint'] = address_fingerprint(previous_df, address_cols)
+        previous_fingerprints.update(previous_df['fingerprint'])
+
+        if key_column and key_column in previous_df.columns:
+            year = batch_file_year(file_name)
+            previous_keys.update((year, str(row_key)) for row_key in previous_df[key_column].dropna())
+
+        geocoded = previous_df.dropna(subset=['geometry'])
+        previous_results.update(zip(geocoded['fingerprint'], geocoded[DELTA_RESULT_COLUMNS].to_dict('records')))
+
+    print(f"Loaded {len(previous_results)} previously geocoded addresses from {geocode_folder}")
+    return previous_results, previous_fingerprints, previous_keys
+
+
+def apply_previous_geocodes(addresses_df, previous_results, previous_fingerprints, previous_keys, address_cols,
+                            year=None, key_column=None):
+    """
+    Carry previous geometry forward for unchanged addresses
+
+    Returns the updated df, a mask of the rows that still need geocoding, and counts of
+    reused rows, retried rows (same address but failed last time) and new/changed rows.
+    New and changed are only told apart with a stable row ID (key_column), BatchID is just the
+    row's position in the extract so it shifts whenever a row is added or removed.
+    Without one they're counted together as new_or_changed.
+    """
+    fingerprints = address_fingerprint(addresses_df, address_cols)
+    if key_column:
+        counts = {'new': 0, 'changed': 0, 'retried': 0, 'reused': 0}
+    else:
+        counts = {'new_or_changed': 0, 'retried': 0, 'reused': 0}
+    delta_mask = pd.Series(True, index=addresses_df.index)
+
+    for idx, fingerprint in zip(addresses_df.index, fingerprints):
+        previous = previous_results.get(fingerprint)
+        if previous is not None:
+            for col, value in previous.items():
+                addresses_df.at[idx, col] = value
+            addresses_df.at[idx, 'geometry'] = wkt.loads(previous['geometry'])
+            delta_mask[idx] = False
+            counts['reused'] += 1
+        elif fingerprint in previous_fingerprints:
+            counts['retried'] += 1
+        elif not key_column:
+            counts['new_or_changed'] += 1
+        elif pd.notna(addresses_df.at[idx, key_column]) and \
+                (year, str(addresses_df.at[idx, key_column])) in previous_keys:
+            counts['changed'] += 1
+        else:
+            counts['new'] += 1
+
+    return addresses_df, delta_mask, counts
+
+
+def format_delta_counts(counts):
+    return ', '.join(f"{count} {label.replace('_', ' ')}" for label, count in counts.items())
+
+
 def main():
     breakdown_folder = rf''
     id_folder = rf''
     output_folder = rf''
     geocode_folder = rf''
 
+    # Optional zone enrichment after geocoding, leave empty to skip
+    # Output column name -> (path to boundary file, zone ID column in that file)
+    # i.e. {'attendance_zone': (rf'', 'SCHOOL_ID'), 'tract': (rf'', 'GEOID')}
+    boundary_files = {}
+
+    # Boundaries are read and indexed once here and reused for every year's output
+    boundary_layers = load_boundary_layers(boundary_files) if boundary_files else {}
+
+    # Delta mode, only send new or changed addresses to Census and the fallback providers
+    # Unchanged rows carry their geometry forward from the previous run's outputs in geocode_folder
+    # address_cols should match the address column names given to the batch files below
+    # source_id_col is a stable row identifier in the breakdown files (i.e. a student ID), carried through to the
+    # outputs as source_id so new and changed rows can be told apart, leave blank if there isn't one
+    delta_mode = False
+    address_cols = ['address', 'city', 'state', 'zip']
+    source_id_col = ''
+    key_column = 'source_id' if source_id_col else None
+    source_ids = {}  # year -> {BatchID: source ID}
+
+    # Read before the loop, the outputs get overwritten as each file finishes
+    if delta_mode:
+        previous_results, previous_fingerprints, previous_keys = load_previous_geocodes(geocode_folder, address_cols,
+                                                                                        key_column=key_column)
+        delta_totals = {}
+
     # Main process
     for file_name in os.listdir(breakdown_folder):
         if file_name.endswith('.csv'):
@@ -195,6 +329,10 @@ def main():
                                                              '', '',
                                                              year=year, output_folder=output_folder)
 
+            # Batch files only have room for the Census columns, keep the stable ID to map back by BatchID
+            if delta_mode and source_id_col:
+                source_ids[year] = dict(zip(df['BatchID'], df[source_id_col]))
+
             original_output = os.path.join(id_folder, f'{file_name}')
             df.to_csv(original_output, index=False)
 
@@ -225,39 +363,66 @@ def main():
         # Prepare and run Census batch geocoding
         census_file, id_map = prepare_census_batch(addresses_df)
 
-
-        print("Waiting 15 seconds before sending batch request...")
-        print("Gotta be nice to the people who are letting us do this for free probably")
-
-        time.sleep(15)  # Add delay before batch processing
-
-        try:
-            print("Running Census batch geocoding...")
-            start_time = time.time()
-
-            census_results = census.addressbatch(census_file)
-            # Add ID column
-            addresses_df = process_census_results(census_results, addresses_df, id_column='batch_id')
-
-            end_time = time.time()
-            elapsed_time = round(end_time - start_time, 2)
-
-            print(f"Census batch geocoding complete in {elapsed_time} seconds.")
-
-            print(f"Census batch geocoding complete. Successes: {geocoding_successes['census']}, "
-                  f"Failures: {geocoding_failures['census']}")
-        except Exception as e:
-            print(f"Exception during Census batch geocoding: {str(e)}")
-            print(f"Exception type: {type(e)}")
-            if hasattr(e, 'response'):
-                print(f"Response status: {e.response.status_code}")
-                print(f"Response content: {e.response.content}")
+        run_census = True
+        if delta_mode:
+            year = batch_file_year(file_name)
+            if key_column:
+                addresses_df[key_column] = addresses_df['batch_id'].map(source_ids.get(year, {}))
+
+            addresses_df, delta_mask, counts = apply_previous_geocodes(addresses_df, previous_results,
+                                                                       previous_fingerprints, previous_keys,
+                                                                       address_cols, year=year,
+                                                                       key_column=key_column)
+            for key, count in counts.items():
+                delta_totals[key] = delta_totals.get(key, 0) + count
+            print(f"Delta for {file_name}: {format_delta_counts(counts)}")
+
+            # Only the new/changed rows go to Census, same format as the batch files
+            run_census = delta_mask.any()
+            if run_census:
+                census_file = 'census_delta_addresses.csv'
+                addresses_df.loc[delta_mask, ['batch_id'] + address_cols].to_csv(census_file, header=False,
+                                                                                 index=False)
+            else:
+                print("No new or changed addresses, skipping Census batch geocoding")
+
+        if run_census:
+            print("Waiting 15 seconds before sending batch request...")
+            print("Gotta be nice to the people who are letting us do this for free probably")
+
+            time.sleep(15)  # Add delay before batch processing
+
+            try:
+                print("Running Census batch geocoding...")
+                start_time = time.time()
+
+                census_results = census.addressbatch(census_file)
+                # Add ID column
+                addresses_df = process_census_results(census_results, addresses_df, id_column='batch_id')
+
+                end_time = time.time()
+                elapsed_time = round(end_time - start_time, 2)
+
+                print(f"Census batch geocoding complete in {elapsed_time} seconds.")
+
+                print(f"Census batch geocoding complete. Successes: {geocoding_successes['census']}, "
+                      f"Failures: {geocoding_failures['census']}")
+            except Exception as e:
+                print(f"Exception during Census batch geocoding: {str(e)}")
+                print(f"Exception type: {type(e)}")
+                if hasattr(e, 'response'):
+                    print(f"Response status: {e.response.status_code}")
+                    print(f"Response content: {e.response.content}")
 
         # Process remaining addresses with backup services
         # This is quite slow with only free services without batch services
         # fair warning if you have a lot of missing addresses
         addresses_df = geocode_remaining_addresses(addresses_df)
 
+        # Assign zone IDs from the boundary layers to every geocoded point
+        if boundary_layers:
+            addresses_df = enrich_with_zones(addresses_df, boundary_layers)
+
         # Create GeoDataFrame and save results
         addresses_df.to_csv(rf'{geocode_folder}\{file_name}', index=False)
 
@@ -273,6 +438,9 @@ def main():
         # print("Breaking the test")
         # break
 
+    if delta_mode:
+        print(f"\nDelta geocoding totals: {format_delta_counts(delta_totals)}")
+
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
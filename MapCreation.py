@@ -10,6 +10,7 @@ from shapely.geometry import Point, Polygon
 
 
 # Creating a .html map with folium and a boundary box
+# Everything is written inline, for large or multi-year outputs use MapTiles.py instead (pre-rendered tiles + year selector)
 
 el_path = r''
 file_name = ''
@@ -0,0 +1,316 @@
+import os
+import re
+import numpy as np
+import pandas as pd
+import folium
+from folium.plugins import GroupedLayerControl
+import matplotlib.pyplot as plt
+from scipy.ndimage import gaussian_filter
+import geopandas as gpd
+from shapely.geometry import Polygon
+
+
+# Tiled version of MapCreation.py for multi-year output
+# Instead of writing every point, the heatmap data and the KDE raster inline into one .html,
+# the density and point layers are pre-rendered into static XYZ .png tiles per year.
+# The .html itself only holds tile URLs and a year selector, so it loads the same no matter how many points there are.
+#
+# Output layout:
+# map_output_folder/map.html
+# map_output_folder/tiles/empty.png
+# map_output_folder/tiles/{year}/density/{z}/{x}/{y}.png
+# map_output_folder/tiles/{year}/points/{z}/{x}/{y}.png
+
+TILE_SIZE = 256
+
+
+def lonlat_to_pixels(lon, lat, zoom):
+    """
+    Convert lon/lat arrays to global Web Mercator pixel coordinates at a zoom level
+    """
+    scale = TILE_SIZE * 2 ** zoom
+    lat_rad = np.radians(np.clip(lat, -85.05112878, 85.05112878))
+    x = (lon + 180.0) / 360.0 * scale
+    y = (1.0 - np.log(np.tan(lat_rad) + 1.0 / np.cos(lat_rad)) / np.pi) / 2.0 * scale
+    return x, y
+
+
+def bucket_by_tile(px, py):
+    """
+    Group point indices by the tile they fall in
+    Returns a dict of (tile_x, tile_y) -> array of point indices
+    """
+    tile_x = (px // TILE_SIZE).astype(np.int64)
+    tile_y = (py // TILE_SIZE).astype(np.int64)
+
+    order = np.lexsort((tile_y, tile_x))
+    keys = np.stack([tile_x[order], tile_y[order]], axis=1)
+    unique_keys, starts = np.unique(keys, axis=0, return_index=True)
+
+    return {(int(key[0]), int(key[1])): group for key, group in zip(unique_keys, np.split(order, starts[1:]))}
+
+
+def neighbourhood_indices(buckets, tile_x, tile_y):
+    """
+    Point indices in a tile and the 8 tiles around it
+    Needed since blurred density and markers near an edge spill over into the next tile
+    """
+    groups = [buckets[(tile_x + dx, tile_y + dy)]
+              for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+              if (tile_x + dx, tile_y + dy) in buckets]
+    return np.concatenate(groups) if groups else np.array([], dtype=np.int64)
+
+
+def render_density_tile(px, py, tile_x, tile_y, sigma):
+    """
+    Gaussian smoothed point density for a single tile, same idea as the KDE layer in MapCreation.py
+    but with a fixed screen space bandwidth (sigma, in pixels) so tiles line up across edges
+    """
+    pad = min(int(4 * sigma), TILE_SIZE)
+    size = TILE_SIZE + 2 * pad
+
+    # Rows are y (north at the top of the tile), columns are x
+    hist, _, _ = np.histogram2d(py - (tile_y * TILE_SIZE - pad), px - (tile_x * TILE_SIZE - pad),
+                                bins=size, range=[[0, size], [0, size]])
+
+    density = gaussian_filter(hist, sigma=sigma)
+    return density[pad:pad + TILE_SIZE, pad:pad + TILE_SIZE]
+
+
+def render_points_tile(px, py, point_colors, tile_x, tile_y, point_radius):
+    """
+    Draw points as small filled circles on a transparent tile
+    """
+    img = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+    cx = np.floor(px - tile_x * TILE_SIZE).astype(np.int64)
+    cy = np.floor(py - tile_y * TILE_SIZE).astype(np.int64)
+
+    for dx in range(-point_radius, point_radius + 1):
+        for dy in range(-point_radius, point_radius + 1):
+            if dx * dx + dy * dy > point_radius * point_radius:
+                continue
+            x = cx + dx
+            y = cy + dy
+            inside_tile = (x >= 0) & (x < TILE_SIZE) & (y >= 0) & (y < TILE_SIZE)
+            img[y[inside_tile], x[inside_tile]] = point_colors[inside_tile]
+
+    return img
+
+
+def save_tile(img, tiles_folder, year, layer, zoom, tile_x, tile_y):
+    tile_folder = os.path.join(tiles_folder, str(year), layer, str(zoom), str(tile_x))
+    os.makedirs(tile_folder, exist_ok=True)
+    plt.imsave(os.path.join(tile_folder, f'{tile_y}.png'), img)
+
+
+def export_year_tiles(gdf, year, tiles_folder, min_zoom=10, max_zoom=16, points_min_zoom=13,
+                      boundary_polygon=None, sigma=6, point_radius=3):
+    """
+    Pre-render the density and point layers of one year's geocoded output into XYZ tiles.
+    Only tiles that actually contain data are written, missing tiles fall back to tiles/empty.png.
+
+    Parameters:
+    gdf: GeoDataFrame of geocoded points in EPSG:4326
+    year: Year label, used for the tile folder
+    tiles_folder: Root folder for the tiles
+    min_zoom/max_zoom: Zoom range to render, Leaflet upscales past max_zoom
+    points_min_zoom: Points are only rendered from this zoom in, they're just noise zoomed out
+    boundary_polygon: Optional shapely Polygon, points inside are green and outside red like MapCreation.py
+    sigma: Density bandwidth in pixels (default 6)
+    point_radius: Point marker radius in pixels (default 3)
+    """
+    lon = gdf.geometry.x.to_numpy()
+    lat = gdf.geometry.y.to_numpy()
+
+    # Same colours as MapCreation.py, green inside the boundary, red outside
+    point_colors = np.tile(np.array([255, 0, 0, 204], dtype=np.uint8), (len(gdf), 1))
+    if boundary_polygon is not None:
+        point_colors[gdf.within(boundary_polygon).to_numpy()] = [0, 128, 0, 204]
+
+    for zoom in range(min_zoom, max_zoom + 1):
+        px, py = lonlat_to_pixels(lon, lat, zoom)
+        buckets = bucket_by_tile(px, py)
+
+        # Blur spills over into neighbouring tiles, so those need rendering as well
+        density_tiles = {(tile_x + dx, tile_y + dy)
+                         for tile_x, tile_y in buckets
+                         for dx in (-1, 0, 1) for dy in (-1, 0, 1)}
+
+        # First pass for the max so density is normalized the same across every tile at this zoom (no seams)
+        max_density = 0.0
+        for tile_x, tile_y in density_tiles:
+            idx = neighbourhood_indices(buckets, tile_x, tile_y)
+            max_density = max(max_density, render_density_tile(px[idx], py[idx], tile_x, tile_y, sigma).max())
+
+        if max_density == 0:
+            continue
+
+        # Second pass writes the tiles, red with alpha from density like the KDE layer in MapCreation.py
+        density_count = 0
+        for tile_x, tile_y in density_tiles:
+            idx = neighbourhood_indices(buckets, tile_x, tile_y)
+            density = render_density_tile(px[idx], py[idx], tile_x, tile_y, sigma) / max_density
+            if density.max() < 1 / 255:
+                continue
+
+            rgba_img = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+            rgba_img[..., 0] = 255
+            rgba_img[..., 3] = (density * 255).astype(np.uint8)
+            save_tile(rgba_img, tiles_folder, year, 'density', zoom, tile_x, tile_y)
+            density_count += 1
+
+        points_count = 0
+        if zoom >= points_min_zoom:
+            for tile_x, tile_y in density_tiles:
+                idx = neighbourhood_indices(buckets, tile_x, tile_y)
+                if not len(idx):
+                    continue
+                img = render_points_tile(px[idx], py[idx], point_colors[idx], tile_x, tile_y, point_radius)
+                if img[..., 3].any():
+                    save_tile(img, tiles_folder, year, 'points', zoom, tile_x, tile_y)
+                    points_count += 1
+
+        print(f"{year} zoom {zoom}: {density_count} density tiles, {points_count} point tiles")
+
+
+def create_tiled_map(years, output_folder, center, zoom_start=12, min_zoom=10, max_zoom=16,
+                     points_min_zoom=13, boundary_coordinates=None):
+    """
+    Write the thin .html map, loads each year's tiles on demand with a year selector
+
+    Parameters:
+    years: Years that have tiles under output_folder/tiles
+    output_folder: Folder the tiles were exported to, the .html is written here as map.html
+    center: [lat, lon] initial view
+    boundary_coordinates: Optional [lat, lon] list for the boundary line
+    """
+    m = folium.Map(location=center, zoom_start=zoom_start)
+
+    # Newest year first, it's the one shown when the map opens
+    year_groups = []
+    for year in sorted(years, reverse=True):
+        year_group = folium.FeatureGroup(name=str(year), show=not year_groups)
+
+        # Tile URLs are relative to the .html so the whole folder can be moved or hosted as is
+        for layer, layer_min_zoom, opacity in [('density', min_zoom, 0.7), ('points', points_min_zoom, 1.0)]:
+            folium.TileLayer(
+                tiles=f'tiles/{year}/{layer}/{{z}}/{{x}}/{{y}}.png',
+                attr='GISBatchEncoder',
+                name=f'{year} {layer.capitalize()}',
+                overlay=True,
+                control=False,
+                opacity=opacity,
+                min_zoom=layer_min_zoom,
+                max_native_zoom=max_zoom,
+                error_tile_url='tiles/empty.png'
+            ).add_to(year_group)
+
+        year_group.add_to(m)
+        year_groups.append(year_group)
+
+    if boundary_coordinates:
+        boundary_group = folium.FeatureGroup(name='Boundary')
+        folium.PolyLine(
+            boundary_coordinates,
+            weight=2,
+            color='blue',
+            opacity=0.8,
+            name='Boundary'
+        ).add_to(boundary_group)
+        boundary_group.add_to(m)
+        folium.LayerControl().add_to(m)
+
+    # Year selector, only one year shown at a time
+    GroupedLayerControl({'Year': year_groups}, exclusive_groups=True, collapsed=False).add_to(m)
+
+    map_file = os.path.join(output_folder, 'map.html')
+    m.save(map_file)
+    print(f"Saved tiled map: {map_file}")
+
+
+def year_from_file_name(file_name):
+    """
+    Year from a GeocoderBatch output name, i.e. census_batch_2020_1_5000.csv, else the last 4 characters
+    """
+    match = re.search(r'census_batch_(\d{4})_', file_name)
+    if match:
+        return match.group(1)
+    return os.path.splitext(file_name)[0][-4:]
+
+
+def main():
+    # GeocoderBatch's geocode_folder, holding every year's geocoded output
+    geocode_folder = rf''
+    map_output_folder = rf''
+
+    # Optional boundary, same format as MapCreation.py, leave blank to skip
+    el_path = r''
+    file_name = ''
+    boundary_name = ''
+
+    min_zoom = 10
+    max_zoom = 16
+    points_min_zoom = 13
+
+    tiles_folder = os.path.join(map_output_folder, 'tiles')
+    os.makedirs(tiles_folder, exist_ok=True)
+
+    # Missing tiles (no data there) point at this instead of 404ing
+    plt.imsave(os.path.join(tiles_folder, 'empty.png'), np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8))
+
+    boundary_polygon = None
+    boundary_coordinates = None
+    if file_name:
+        el_df = pd.read_csv(fr'{el_path}\{file_name}', low_memory=False)
+        el_df = el_df[el_df['NAME'] == boundary_name]
+
+        # Lat/Long for folium, Long/Lat for shapely
+        boundary_coordinates = el_df[['POINT_Y', 'POINT_X']].values.tolist()
+        boundary_polygon = Polygon([[coord[1], coord[0]] for coord in boundary_coordinates])
+
+    # Group the per batch outputs by year
+    year_files = {}
+    for geocode_file in os.listdir(geocode_folder):
+        if geocode_file.endswith('.csv'):
+            year_files.setdefault(year_from_file_name(geocode_file), []).append(geocode_file)
+
+    rendered_years = []
+    center_points = []
+    for year, files in sorted(year_files.items()):
+        geocoded_df = pd.concat([pd.read_csv(rf'{geocode_folder}\{geocode_file}', low_memory=False)
+                                 for geocode_file in files], ignore_index=True)
+        geocoded_df = geocoded_df.dropna(subset=['geometry'])
+
+        # Nothing geocoded for this year, leave it out of the tiles and the year selector
+        if geocoded_df.empty:
+            print(f"No geocoded points for {year}, skipping")
+            continue
+
+        gdf = gpd.GeoDataFrame(
+            geocoded_df,
+            geometry=gpd.GeoSeries.from_wkt(geocoded_df['geometry']),
+            crs="EPSG:4326"
+        )
+        print(f"Rendering tiles for {year}: {len(gdf)} points")
+
+        export_year_tiles(gdf, year, tiles_folder, min_zoom=min_zoom, max_zoom=max_zoom,
+                          points_min_zoom=points_min_zoom, boundary_polygon=boundary_polygon)
+        rendered_years.append(year)
+        center_points.append([gdf.geometry.y.mean(), gdf.geometry.x.mean()])
+
+    if not rendered_years:
+        print("No geocoded points in any year, no map created")
+        return
+
+    # Center on the boundary if there is one, else on the points
+    if boundary_coordinates:
+        center = np.mean(boundary_coordinates, axis=0).tolist()
+    else:
+        center = np.mean(center_points, axis=0).tolist()
+
+    create_tiled_map(rendered_years, map_output_folder, center, min_zoom=min_zoom, max_zoom=max_zoom,
+                     points_min_zoom=points_min_zoom, boundary_coordinates=boundary_coordinates)
+
+
+if __name__ == '__main__':
+    main()